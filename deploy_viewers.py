@@ -1,37 +1,286 @@
 import yaml
-import copy
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from kubernetes import client, config
+from kubernetes.client import rest
 import argparse
+import os
+import subprocess
 import sys
 
-def load_template(template_path):
-    """Loads a multi-document YAML file."""
+try:
+    import orjson
+except ImportError: # Optional; falls back to the stdlib json encoder
+    orjson = None
+
+def load_deployment_and_service(template_path):
+    """Returns the first Deployment and Service from a multi-document YAML file.
+
+    The result is cached as JSON next to the template and reused for as long
+    as the template's mtime and size are unchanged. JSON rather than pickle,
+    so a tampered cache file can at worst hand back wrong data, never run code.
+    """
+    cache_path = f"{template_path}.cache.json"
+    stat = os.stat(template_path)
+    cache_key = [stat.st_mtime_ns, stat.st_size]
+    try:
+        with open(cache_path, 'r') as f:
+            cached_key, deployment, service = json.load(f)
+        if cached_key == cache_key:
+            return deployment, service
+    except (OSError, ValueError, TypeError):
+        pass # Missing, unreadable or malformed cache; parse the YAML instead
+
+    deployment = service = None
+    # Prefer libyaml's C loader when PyYAML was built with it
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(template_path, 'r') as f:
-        return list(yaml.safe_load_all(f))
+        # Documents are parsed lazily, so stop as soon as both are found
+        for doc in yaml.load_all(f, Loader=Loader):
+            kind = doc.get("kind") if doc else None
+            if kind == "Deployment" and deployment is None:
+                deployment = doc
+            elif kind == "Service" and service is None:
+                service = doc
+            if deployment is not None and service is not None:
+                break
+
+    # Write to a temporary file first so a concurrent run never reads a partial cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump([cache_key, deployment, service], f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        # The cache is only an optimization, e.g., the directory may be
+        # read-only or the template may hold values JSON can't represent
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return deployment, service
 
 def get_available_vpn_configs(api_client, namespace, config_map_name):
     """Fetches VPN config names from a ConfigMap."""
     core_v1 = client.CoreV1Api(api_client)
     try:
-        config_map = core_v1.read_namespaced_config_map(name=config_map_name, namespace=namespace)
-        # Assumes VPN files in ConfigMap data end with .ovpn
-        # The VPN_CONFIG env var should be the name without .ovpn
-        vpn_names = [key.replace('.ovpn', '') for key in config_map.data.keys() if key.endswith('.ovpn')]
-        if not vpn_names:
-            print(f"Warning: No .ovpn files found in ConfigMap '{config_map_name}' data keys.")
-        return vpn_names
+        # resource_version='0' lets the API server answer from its watch cache
+        # instead of doing a quorum read against etcd
+        config_maps = core_v1.list_namespaced_config_map(
+            namespace=namespace, field_selector=f"metadata.name={config_map_name}", resource_version='0').items
     except client.ApiException as e:
-        if e.status == 404:
-            print(f"Error: ConfigMap '{config_map_name}' not found in namespace '{namespace}'.")
-            print("Please ensure the ConfigMap containing VPN configurations exists and is correctly named.")
-            print("The ConfigMap should have data entries like 'vpn1.ovpn: <config_content>', 'vpn2.ovpn: <config_content>', etc.")
-        else:
+        if e.status != 403:
             print(f"Error fetching ConfigMap '{config_map_name}': {e}")
+            sys.exit(1)
+        # list needs broader RBAC than get; a Role scoped with resourceNames
+        # only grants get on the named ConfigMap, so read it directly instead
+        try:
+            config_maps = [core_v1.read_namespaced_config_map(name=config_map_name, namespace=namespace)]
+        except client.ApiException as e_read:
+            if e_read.status != 404:
+                print(f"Error fetching ConfigMap '{config_map_name}': {e_read}")
+                sys.exit(1)
+            config_maps = []
+
+    if not config_maps:
+        print(f"Error: ConfigMap '{config_map_name}' not found in namespace '{namespace}'.")
+        print("Please ensure the ConfigMap containing VPN configurations exists and is correctly named.")
+        print("The ConfigMap should have data entries like 'vpn1.ovpn: <config_content>', 'vpn2.ovpn: <config_content>', etc.")
         sys.exit(1)
-    except AttributeError: # If config_map.data is None
+
+    config_map = config_maps[0]
+    if not config_map.data:
         print(f"Error: ConfigMap '{config_map_name}' in namespace '{namespace}' has no data field or it\'s empty.")
         sys.exit(1)
 
+    # Assumes VPN files in ConfigMap data end with .ovpn
+    # The VPN_CONFIG env var should be the name without .ovpn
+    vpn_names = [key.replace('.ovpn', '') for key in config_map.data.keys() if key.endswith('.ovpn')]
+    if not vpn_names:
+        print(f"Warning: No .ovpn files found in ConfigMap '{config_map_name}' data keys.")
+    return vpn_names
+
+class _OrjsonEncoder:
+    """Stands in for the json module inside kubernetes.client.rest, encoding bodies with orjson."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        if kwargs: # orjson has no equivalent for json.dumps options
+            return json.dumps(obj, **kwargs)
+        # Hand urllib3 the UTF-8 bytes as-is; a str body may be re-encoded as latin-1
+        return orjson.dumps(obj)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+def install_fast_json_encoder():
+    """Swaps the REST client's request body encoder for orjson when it is installed."""
+    if orjson is not None:
+        # Bodies reach rest.py as already-sanitized dicts, so the wire format
+        # is unchanged apart from insignificant whitespace.
+        rest.json = _OrjsonEncoder()
+
+def create_api_client(connection_pool_maxsize):
+    """Builds an ApiClient from the loaded kube config with a larger urllib3 pool."""
+    # The pool is sized when the client is constructed, so this has to be set
+    # on the configuration beforehand. Anything smaller than the number of
+    # worker threads makes them queue for a connection.
+    k8s_api_client_config = client.Configuration.get_default_copy()
+    k8s_api_client_config.connection_pool_maxsize = connection_pool_maxsize
+    return client.ApiClient(k8s_api_client_config)
+
+def make_deployment(base_deployment_template, name, instance_label, replicas, selector_labels, pod_labels, env_overrides):
+    """Builds one instance's Deployment body from the base template.
+
+    Only the dicts along the paths that change per instance are rebuilt;
+    every other subtree (volumes, probes, init containers, ...) is shared
+    with the template, so nothing is re-parsed or deep-copied. The label
+    dicts are built by the caller and may be shared between bodies.
+    """
+    base_metadata = base_deployment_template['metadata']
+    base_spec = base_deployment_template['spec']
+    base_selector = base_spec['selector']
+    base_pod_template = base_spec['template']
+    base_pod_metadata = base_pod_template.get('metadata', {})
+    base_pod_spec = base_pod_template['spec']
+
+    containers = []
+    for container in base_pod_spec['containers']:
+        if container['name'] == 'viewer-box':
+            overrides = dict(env_overrides)
+            # Replace existing entries where they are, then add whatever was missing
+            env_vars = [
+                {'name': ev['name'], 'value': overrides.pop(ev['name'])} if ev['name'] in overrides else ev
+                for ev in container.get('env', [])
+            ]
+            env_vars.extend({'name': env_name, 'value': value} for env_name, value in overrides.items())
+            container = {**container, 'env': env_vars}
+        containers.append(container)
+
+    return {
+        **base_deployment_template,
+        'metadata': {
+            **base_metadata,
+            'name': name,
+            'labels': {**base_metadata.get('labels', {}), 'deployment-instance': instance_label},
+        },
+        'spec': {
+            **base_spec,
+            'replicas': replicas,
+            'selector': {
+                **base_selector,
+                'matchLabels': selector_labels,
+            },
+            'template': {
+                **base_pod_template,
+                'metadata': {
+                    **base_pod_metadata,
+                    'labels': pod_labels,
+                },
+                'spec': {**base_pod_spec, 'containers': containers},
+            },
+        },
+    }
+
+def make_service(base_service_template, name, instance_label, selector_labels):
+    """Builds one instance's Service body, sharing the unchanged parts of the base template."""
+    base_metadata = base_service_template['metadata']
+    base_spec = base_service_template['spec']
+    return {
+        **base_service_template,
+        'metadata': {
+            **base_metadata,
+            'name': name,
+            'labels': {**base_metadata.get('labels', {}), 'deployment-instance': instance_label},
+        },
+        'spec': {
+            **base_spec,
+            'selector': selector_labels,
+        },
+    }
+
+# Server-side apply creates or updates in one request, so existing objects
+# need no separate conflict/replace round trip. It needs kubernetes >= 36 for
+# the _content_type keyword; older clients fall back to create/replace.
+FIELD_MANAGER = 'deploy-viewers'
+# Despite the +yaml content type, bodies are dicts and the client serializes
+# them as JSON (which is valid YAML) — never yaml.dump a body before sending it.
+APPLY_CONTENT_TYPE = 'application/apply-patch+yaml'
+
+def create_or_replace_deployment(apps_v1_api, namespace, deployment_body, vpn_config_name):
+    """Creates a Deployment, replacing it if it already exists. Returns (succeeded, message)."""
+    deployment_name = deployment_body['metadata']['name']
+    try:
+        apps_v1_api.create_namespaced_deployment(namespace=namespace, body=deployment_body)
+        return True, f"Deployment '{deployment_name}' created with VPN '{vpn_config_name}'."
+    except client.ApiException as e:
+        if e.status == 409: # Conflict
+            try:
+                apps_v1_api.replace_namespaced_deployment(name=deployment_name, namespace=namespace, body=deployment_body)
+                return True, f"Deployment '{deployment_name}' replaced with VPN '{vpn_config_name}'."
+            except client.ApiException as e_replace:
+                return False, f"Error replacing Deployment '{deployment_name}': {e_replace}"
+        return False, f"Error creating Deployment '{deployment_name}': {e}"
+
+def create_service(core_v1_api, namespace, service_body):
+    """Creates a Service, leaving an existing one untouched. Returns (succeeded, message)."""
+    service_name = service_body['metadata']['name']
+    try:
+        core_v1_api.create_namespaced_service(namespace=namespace, body=service_body)
+        return True, f"Service '{service_name}' created."
+    except client.ApiException as e:
+        if e.status == 409: # Conflict
+            return True, f"Service '{service_name}' already exists. Skipping creation/update."
+        return False, f"Error creating Service '{service_name}': {e}"
+
+def apply_deployment(apps_v1_api, namespace, deployment_body, vpn_config_name):
+    """Creates or updates a Deployment with server-side apply. Returns (succeeded, message)."""
+    deployment_name = deployment_body['metadata']['name']
+    try:
+        # force takes ownership of fields last written by another manager,
+        # e.g. Deployments created by earlier versions of this script
+        apps_v1_api.patch_namespaced_deployment(
+            name=deployment_name, namespace=namespace, body=deployment_body,
+            field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
+        return True, f"Deployment '{deployment_name}' applied with VPN '{vpn_config_name}'."
+    except client.ApiTypeError:
+        # kubernetes < 36 rejects _content_type before sending anything
+        return create_or_replace_deployment(apps_v1_api, namespace, deployment_body, vpn_config_name)
+    except client.ApiException as e:
+        return False, f"Error applying Deployment '{deployment_name}': {e}"
+
+def apply_service(core_v1_api, namespace, service_body):
+    """Creates or updates a Service with server-side apply. Returns (succeeded, message)."""
+    service_name = service_body['metadata']['name']
+    try:
+        core_v1_api.patch_namespaced_service(
+            name=service_name, namespace=namespace, body=service_body,
+            field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
+        return True, f"Service '{service_name}' applied."
+    except client.ApiTypeError:
+        # kubernetes < 36 rejects _content_type before sending anything
+        return create_service(core_v1_api, namespace, service_body)
+    except client.ApiException as e:
+        return False, f"Error applying Service '{service_name}': {e}"
+
+def apply_with_kubectl(namespace, bodies):
+    """Applies every body in a single `kubectl apply --server-side` run."""
+    items = [body for deployment_body, service_body, _ in bodies for body in (deployment_body, service_body) if body]
+    # kubectl reads a v1 List as one stream, so the whole batch is encoded once
+    manifest = {'apiVersion': 'v1', 'kind': 'List', 'items': items}
+    payload = orjson.dumps(manifest) if orjson is not None else json.dumps(manifest).encode()
+    command = [
+        'kubectl', 'apply', '--server-side', f'--field-manager={FIELD_MANAGER}', '--force-conflicts',
+        '--namespace', namespace, '-f', '-',
+    ]
+    try:
+        result = subprocess.run(command, input=payload)
+    except FileNotFoundError:
+        print("Error: kubectl not found on PATH. Install it or drop --use-kubectl.")
+        sys.exit(1)
+    if result.returncode != 0:
+        print(f"Error: kubectl apply exited with status {result.returncode}.")
+        sys.exit(result.returncode)
 
 def main():
     parser = argparse.ArgumentParser(description="Deploy multiple viewer instances with unique VPNs.")
@@ -41,6 +290,8 @@ def main():
     parser.add_argument("--namespace", default="stream-viewers", help="Kubernetes namespace for deployments.")
     parser.add_argument("--vpn-configmap-name", default="vpn-configs", help="Name of the ConfigMap holding VPN configurations.")
     parser.add_argument("--replicas-per-deployment", type=int, default=1, help="Number of replicas for each deployment.")
+    parser.add_argument("--use-kubectl", action="store_true", help="Apply all manifests in one 'kubectl apply --server-side' run instead of per-object API calls.")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Maximum number of objects submitted to the API server in parallel.")
 
     args = parser.parse_args()
 
@@ -53,13 +304,13 @@ def main():
             print("Error: Could not load Kubernetes configuration. Ensure valid kubeconfig or running in-cluster.")
             sys.exit(1)
     
-    k8s_api_client = client.ApiClient() # Use ApiClient for passing to API classes
+    install_fast_json_encoder()
+    # One ApiClient shared by every API class and worker thread
+    k8s_api_client = create_api_client(max(32, args.max_concurrency))
     apps_v1_api = client.AppsV1Api(k8s_api_client)
     core_v1_api = client.CoreV1Api(k8s_api_client)
 
-    templates = load_template(args.template_file)
-    base_deployment_template = next((tpl for tpl in templates if tpl and tpl.get("kind") == "Deployment"), None)
-    base_service_template = next((tpl for tpl in templates if tpl and tpl.get("kind") == "Service"), None)
+    base_deployment_template, base_service_template = load_deployment_and_service(args.template_file)
 
     if not base_deployment_template:
         print(f"Error: Could not find a Deployment definition in '{args.template_file}'")
@@ -75,91 +326,104 @@ def main():
         print(f"Error: Requested {args.num_deployments} deployments, but only {len(available_vpns)} VPNs available.")
         sys.exit(1)
 
-    selected_vpns = available_vpns[:args.num_deployments]
+    # These are the same for every instance, so look them up once.
+    original_deployment_name = base_deployment_template['metadata'].get('name', 'viewer-deployment')
+    base_selector_labels = base_deployment_template['spec']['selector']['matchLabels']
+    base_pod_labels = base_deployment_template['spec']['template'].get('metadata', {}).get('labels', {})
+    original_component_label = base_selector_labels.get('component', 'viewer')
+    if base_service_template:
+        original_service_name = base_service_template['metadata'].get('name', 'viewer-service')
+        base_service_selector = base_service_template['spec']['selector']
+
+    # The pod template and Service selector normally carry the same labels as
+    # the Deployment selector; when they do, each instance builds that label
+    # dict once and shares it between the bodies instead of building copies.
+    pod_labels_match_selector = base_pod_labels == base_selector_labels
+    service_selector_matches = bool(base_service_template) and base_service_selector == base_selector_labels
+
+    if not any(container['name'] == 'viewer-box' for container in base_deployment_template['spec']['template']['spec']['containers']):
+        print(f"Warning: Container 'viewer-box' not found in '{args.template_file}'. Env vars not set.")
 
+    # Instance labels ("0", "1", ...), name suffixes ("-0", ...) and BOX_NAME
+    # values ("box-0", ...), each formatted once before the loop
+    instance_labels = [str(i) for i in range(args.num_deployments)]
+    instance_suffixes = [f"-{label}" for label in instance_labels]
+    box_names = [f"box{suffix}" for suffix in instance_suffixes]
+
+    # Bodies share every unchanged subtree with the templates; the client only
+    # reads them when serializing, so nothing here may mutate a body in place.
+    bodies = []
     for i in range(args.num_deployments):
-        vpn_config_name = selected_vpns[i]
-        # Use a consistent suffix, e.g., instance number
-        instance_suffix = f"-{i}" 
-        
-        # --- Prepare Deployment ---
-        current_deployment = copy.deepcopy(base_deployment_template)
-        
-        original_deployment_name = current_deployment['metadata'].get('name', 'viewer-deployment')
-        new_deployment_name = f"{original_deployment_name}{instance_suffix}"
-        
-        original_component_label = current_deployment['spec']['selector']['matchLabels'].get('component', 'viewer')
-        new_component_label = f"{original_component_label}{instance_suffix}"
-
-        current_deployment['metadata']['name'] = new_deployment_name
-        current_deployment['metadata'].setdefault('labels', {})['deployment-instance'] = str(i)
-
-        current_deployment['spec']['replicas'] = args.replicas_per_deployment
-        
-        current_deployment['spec']['selector']['matchLabels']['component'] = new_component_label
-        current_deployment['spec']['selector']['matchLabels']['deployment-instance'] = str(i) # For unique selection
-
-        current_deployment['spec']['template']['metadata'].setdefault('labels', {})
-        current_deployment['spec']['template']['metadata']['labels']['component'] = new_component_label
-        current_deployment['spec']['template']['metadata']['labels']['deployment-instance'] = str(i)
-
-
-        container_updated = False
-        for container in current_deployment['spec']['template']['spec']['containers']:
-            if container['name'] == 'viewer-box':
-                env_vars = container.get('env', [])
-                # Update existing or add new
-                env_map = {ev['name']: ev for ev in env_vars}
-
-                env_map['BOX_NAME'] = {'name': 'BOX_NAME', 'value': f"box{instance_suffix}"}
-                env_map['STREAM_URL'] = {'name': 'STREAM_URL', 'value': args.stream_url}
-                env_map['VPN_CONFIG'] = {'name': 'VPN_CONFIG', 'value': vpn_config_name}
-                
-                container['env'] = list(env_map.values())
-                container_updated = True
-                break
-        
-        if not container_updated:
-            print(f"Warning: Container 'viewer-box' not found in deployment {new_deployment_name}. Env vars not set.")
+        vpn_config_name = available_vpns[i] # In range: checked against len(available_vpns) above
+        instance_suffix = instance_suffixes[i]
+        instance_label = instance_labels[i]
+        new_component_label = original_component_label + instance_suffix
 
-        try:
-            apps_v1_api.create_namespaced_deployment(namespace=args.namespace, body=current_deployment)
-            print(f"Deployment '{new_deployment_name}' created with VPN '{vpn_config_name}'.")
-        except client.ApiException as e:
-            if e.status == 409: # Conflict
-                try:
-                    apps_v1_api.replace_namespaced_deployment(name=new_deployment_name, namespace=args.namespace, body=current_deployment)
-                    print(f"Deployment '{new_deployment_name}' replaced with VPN '{vpn_config_name}'.")
-                except client.ApiException as e_replace:
-                    print(f"Error replacing Deployment '{new_deployment_name}': {e_replace}")
-            else:
-                print(f"Error creating Deployment '{new_deployment_name}': {e}")
-
-        # --- Prepare Service (if template exists) ---
+        # For unique selection
+        selector_labels = {**base_selector_labels, 'component': new_component_label, 'deployment-instance': instance_label}
+        if pod_labels_match_selector:
+            pod_labels = selector_labels
+        else:
+            pod_labels = {**base_pod_labels, 'component': new_component_label, 'deployment-instance': instance_label}
+
+        current_deployment = make_deployment(
+            base_deployment_template,
+            name=original_deployment_name + instance_suffix,
+            instance_label=instance_label,
+            replicas=args.replicas_per_deployment,
+            selector_labels=selector_labels,
+            pod_labels=pod_labels,
+            env_overrides={
+                'BOX_NAME': box_names[i],
+                'STREAM_URL': args.stream_url,
+                'VPN_CONFIG': vpn_config_name,
+            },
+        )
+
+        current_service = None
         if base_service_template:
-            current_service = copy.deepcopy(base_service_template)
-            original_service_name = current_service['metadata'].get('name', 'viewer-service')
-            new_service_name = f"{original_service_name}{instance_suffix}"
+            if service_selector_matches:
+                service_selector = selector_labels
+            else: # Match pod labels
+                service_selector = {**base_service_selector, 'component': new_component_label, 'deployment-instance': instance_label}
+            current_service = make_service(
+                base_service_template,
+                name=original_service_name + instance_suffix,
+                instance_label=instance_label,
+                selector_labels=service_selector,
+            )
 
-            current_service['metadata']['name'] = new_service_name
-            current_service['metadata'].setdefault('labels', {})['deployment-instance'] = str(i)
-            
-            current_service['spec']['selector']['component'] = new_component_label
-            current_service['spec']['selector']['deployment-instance'] = str(i) # Match pod labels
+        bodies.append((current_deployment, current_service, vpn_config_name))
 
+    if args.use_kubectl:
+        apply_with_kubectl(args.namespace, bodies)
+        print(f"Successfully processed {args.num_deployments} deployments.")
+        return
+
+    # Every object is independent (a Service need not wait for its Deployment),
+    # so submit them all concurrently rather than paying one API server round
+    # trip after another.
+    with ThreadPoolExecutor(max_workers=max(1, args.max_concurrency)) as executor:
+        futures = {}
+        for deployment_body, service_body, vpn_config_name in bodies:
+            futures[executor.submit(apply_deployment, apps_v1_api, args.namespace, deployment_body, vpn_config_name)] = deployment_body['metadata']['name']
+            if service_body:
+                futures[executor.submit(apply_service, core_v1_api, args.namespace, service_body)] = service_body['metadata']['name']
+        # Workers only return their messages; printing from this thread keeps
+        # lines from different objects from interleaving.
+        failed = 0
+        for future in as_completed(futures):
             try:
-                core_v1_api.create_namespaced_service(namespace=args.namespace, body=current_service)
-                print(f"Service '{new_service_name}' created.")
-            except client.ApiException as e:
-                if e.status == 409: # Conflict
-                    # Service updates can be tricky. A common pattern is delete and recreate if changed,
-                    # or patch. For simplicity, we'll just note it exists.
-                    # You could implement replace_namespaced_service if needed.
-                    print(f"Service '{new_service_name}' already exists. Skipping creation/update.")
-                else:
-                    print(f"Error creating Service '{new_service_name}': {e}")
-        
-        print("---")
+                succeeded, message = future.result()
+            except Exception as e: # Keep one failed object from aborting the rest
+                succeeded, message = False, f"Error applying '{futures[future]}': {e}"
+            print(message)
+            if not succeeded:
+                failed += 1
+
+    if failed:
+        print(f"Error: {failed} of {len(futures)} objects failed to apply.")
+        sys.exit(1)
 
     print(f"Successfully processed {args.num_deployments} deployments.")
 